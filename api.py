@@ -0,0 +1,221 @@
+"""JSON API over the AgImpacts data, for other services and dashboards.
+
+Serves the same queries as the web tool (queries.py) without running a Streamlit
+session. Responses are cached per workbook version and carry an ETag, so clients that
+send If-None-Match get an empty 304 when nothing changed.
+
+    python api.py --port 8502
+
+GET /commodities
+GET /commodities/<commodity>/ghg                      distinct GHG values (slider stops)
+GET /commodities/<commodity>/rows?low=&high=&label_by=Country&sort=&descending=&search=&offset=0&limit=100
+GET /commodities/<commodity>/rows.csv?low=&high=&label_by=&sort=&descending=&search=   all matching rows, streamed
+GET /commodities/<commodity>/stats/<indicator>?low=&high=
+GET /commodities/<commodity>/groups/<indicator>?by=Country
+GET /commodities/<commodity>/trendline/<indicator>?kind=ols&low=&high=&label_by=
+
+Tornado is already installed as part of Streamlit.
+"""
+import argparse
+import functools
+import json
+import math
+
+import numpy as np
+import tornado.ioloop
+import tornado.web
+
+import data_store
+import queries
+
+indicators = data_store.numerical_cols
+max_limit = 1000
+
+
+class QueryError(ValueError):
+    pass
+
+
+def jsonable(value):
+    # NaN/inf become null and numpy scalars/arrays become plain Python values
+    if isinstance(value, dict):
+        return {str(key): jsonable(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return [jsonable(item) for item in value]
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and not math.isfinite(value):
+        return None
+    return value
+
+
+def float_arg(args, name):
+    value = args.get(name)
+    if value in (None, ''):
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        raise QueryError(f'{name} must be a number')
+
+
+def int_arg(args, name, default):
+    try:
+        return max(int(args.get(name, default)), 0)
+    except ValueError:
+        raise QueryError(f'{name} must be a whole number')
+
+
+def label_by_arg(args):
+    labels = tuple(label for label in args.get('label_by', '').split(',') if label)
+    unknown = set(labels) - set(data_store.label_cols)
+    if unknown:
+        raise QueryError(f"label_by must be one of {', '.join(data_store.label_cols)}")
+    return labels
+
+
+def check(ds, commodity, indicator=None):
+    if commodity not in ds.frames:
+        raise tornado.web.HTTPError(404, reason=f'Unknown commodity: {commodity}')
+    if indicator is not None and indicator not in indicators:
+        raise tornado.web.HTTPError(404, reason=f'Unknown indicator: {indicator}')
+
+
+def commodities_query(ds, args):
+    return {'commodities': queries.commodities(ds)}
+
+
+def ghg_query(ds, args, commodity):
+    check(ds, commodity)
+    return {'commodity': commodity, 'stops': queries.ghg_stops(ds, commodity)}
+
+
+def selected_rows(ds, args, commodity):
+    # (rows, positions) for the rows endpoints: GHG range and labels, then search and sort
+    check(ds, commodity)
+    rows = queries.select(ds, commodity, float_arg(args, 'low'), float_arg(args, 'high'), label_by_arg(args))
+    sort_by = args.get('sort') or None
+    if sort_by is not None and sort_by not in queries.table_cols:
+        raise QueryError(f"sort must be one of {', '.join(queries.table_cols)}")
+    descending = args.get('descending', '').lower() in ('1', 'true', 'yes')
+    return rows, queries.table_positions(rows[queries.table_cols], sort_by, not descending, args.get('search', ''))
+
+
+def rows_query(ds, args, commodity):
+    rows, positions = selected_rows(ds, args, commodity)
+    offset = int_arg(args, 'offset', 0)
+    limit = min(int_arg(args, 'limit', 100), max_limit)
+    page = queries.table_page(rows, positions, offset, limit, queries.table_cols)
+    return {'commodity': commodity, 'total': len(positions), 'offset': offset,
+            'rows': page.astype(object).where(page.notna(), None).to_dict(orient='records')}
+
+
+def stats_query(ds, args, commodity, indicator):
+    check(ds, commodity, indicator)
+    stats = queries.range_stats(ds, commodity, indicator, float_arg(args, 'low'), float_arg(args, 'high'))
+    return dict(stats, commodity=commodity, indicator=indicator)
+
+
+def groups_query(ds, args, commodity, indicator):
+    check(ds, commodity, indicator)
+    by = args.get('by', 'Country')
+    if by not in data_store.label_cols:
+        raise QueryError(f"by must be one of {', '.join(data_store.label_cols)}")
+    stats = queries.group_stats(ds, commodity, indicator, by)
+    return {'commodity': commodity, 'indicator': indicator, 'by': by,
+            'groups': {group: row.to_dict() for group, row in stats.iterrows()}}
+
+
+def trendline_query(ds, args, commodity, indicator):
+    check(ds, commodity, indicator)
+    kind = args.get('kind', 'ols')
+    if kind not in ('ols', 'lowess'):
+        raise QueryError('kind must be ols or lowess')
+    index = ds.ghg_indexes[commodity]
+    low = float_arg(args, 'low')
+    high = float_arg(args, 'high')
+    # fill in the full range so the fit cache key is the same as the web tool's
+    low = index.stops[0] if low is None else low
+    high = index.stops[-1] if high is None else high
+    fits = queries.trendline_fits(ds, commodity, indicator, low, high, kind, label_by_arg(args))
+    return {'commodity': commodity, 'indicator': indicator, 'kind': kind, 'fits': {
+        name: None if fit is None else {
+            'x': fit.x, 'y': fit.y,
+            'table': None if fit.table is None else fit.table.to_dict(orient='index')}
+        for name, fit in fits.items()}}
+
+
+def dataset(digest):
+    # loading a new workbook version is slow, so this only runs in the executor
+    return queries.load_dataset(data_store.DATA_FILE, digest)
+
+
+@functools.lru_cache(maxsize=1024)
+def response_body(digest, query, path_args, args):
+    # digest is part of the key so a new workbook never serves old responses
+    ds = dataset(digest)
+    return json.dumps(jsonable(query(ds, dict(args), *path_args)), separators=(',', ':'))
+
+
+class QueryHandler(tornado.web.RequestHandler):
+    def initialize(self, query):
+        self.query = query
+
+    async def get(self, *path_args):
+        digest = queries.current_digest()
+        args = tuple(sorted((name, self.get_argument(name)) for name in self.request.arguments))
+        try:
+            # computed off the event loop, including (re)loading the data; cached bodies
+            # come back immediately
+            body = await tornado.ioloop.IOLoop.current().run_in_executor(
+                None, response_body, digest, self.query, path_args, args)
+        except QueryError as e:
+            raise tornado.web.HTTPError(400, reason=str(e))
+        self.set_header('Content-Type', 'application/json')
+        self.set_header('Cache-Control', 'public, max-age=60')
+        # tornado hashes the body into an ETag and answers If-None-Match with 304
+        self.finish(body)
+
+
+class CsvHandler(tornado.web.RequestHandler):
+    async def get(self, commodity):
+        digest = queries.current_digest()
+        args = {name: self.get_argument(name) for name in self.request.arguments}
+        try:
+            rows, positions = await tornado.ioloop.IOLoop.current().run_in_executor(
+                None, lambda: selected_rows(dataset(digest), args, commodity))
+        except QueryError as e:
+            raise tornado.web.HTTPError(400, reason=str(e))
+        self.set_header('Content-Type', 'text/csv')
+        self.set_header('Content-Disposition', f'attachment; filename="{commodity}.csv"')
+        # sent a chunk at a time, so large selections never sit in memory as one string
+        for chunk in queries.csv_chunks(rows, positions, queries.table_cols):
+            self.write(chunk)
+            await self.flush()
+
+
+def make_app():
+    name = r'([^/]+)'
+    return tornado.web.Application([
+        (r'/commodities', QueryHandler, {'query': commodities_query}),
+        (rf'/commodities/{name}/ghg', QueryHandler, {'query': ghg_query}),
+        (rf'/commodities/{name}/rows', QueryHandler, {'query': rows_query}),
+        (rf'/commodities/{name}/rows\.csv', CsvHandler),
+        (rf'/commodities/{name}/stats/{name}', QueryHandler, {'query': stats_query}),
+        (rf'/commodities/{name}/groups/{name}', QueryHandler, {'query': groups_query}),
+        (rf'/commodities/{name}/trendline/{name}', QueryHandler, {'query': trendline_query}),
+    ])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serve AgImpacts data as JSON.')
+    parser.add_argument('--port', type=int, default=8502)
+    args = parser.parse_args(argv)
+    queries.current_dataset()  # load the data before taking requests
+    make_app().listen(args.port)
+    print(f'Serving AgImpacts data on http://localhost:{args.port}/commodities')
+    tornado.ioloop.IOLoop.current().start()
+
+
+if __name__ == '__main__':
+    main()
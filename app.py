@@ -1,6 +1,8 @@
 import streamlit as st
 import pandas as pd
-import plotly.express as px
+import charts
+import data_store
+import queries
 from bokeh.models.widgets import Div
 st.set_page_config(layout='wide')
 
@@ -8,68 +10,39 @@ st.set_page_config(layout='wide')
 st.title('Welcome to the AgImpacts Interactive Web Tool!')
 st.markdown('This interactive web tool is a part of AgImpacts, a project conducted by ten MIT undergraduates for the World Wildlife Fund. AgImpacts analyzes environmental trade-offs for ten agricultural commodities across five indicators: GHG emissions, land use, eutrophication potential, acidification potential, and freshwater withdrawal. To learn more about these topics and our project, [visit the AgImpacts website.](https://agimpacts.wpengine.com/)', unsafe_allow_html=True)
 st.markdown('Select a commodity of interest on the left sidebar to start. For a comprehensive guide to using this web tool, click on the **Tool Usage Guide** section below.')
-@st.cache(show_spinner=False, persist=True)  # save computation between reruns
-def get_full_df():
-    with st.spinner('Loading excel spreadsheet...'):  # show a progress meter
-        full_df = pd.read_excel('AgImpacts_Raw_Data.xlsx', sheet_name=1,
-                                header=1)
-    return full_df
+# The dataset (cleaned frames, GHG indexes and aggregate cube) is never modified by the app,
+# so allow_output_mutation just skips re-hashing it on every rerun
+@st.cache(show_spinner=False, allow_output_mutation=True)
+def get_dataset(digest):  # digest of the spreadsheet, so a new spreadsheet is reloaded
+    with st.spinner('Loading raw data...'):  # show a progress meter
+        return queries.load_dataset(data_store.DATA_FILE, digest)
 
-def format_col(df, col):
-    del_things = (',', '-', '%', ' ', '  ')
-    for del_thing in del_things:
-        df[col] = df[col].replace(del_thing, '', regex=True)
-    df[col] = df[col].replace('', 'NaN').replace('', 'nan').astype(float, errors='ignore')
-    return df[col].dropna()
+# Figures are cached by every input that changes them and evicted least recently used first.
+# Streamlit only reads the cached figures, so they are safe to share between reruns.
+@st.cache(show_spinner=False, max_entries=128, allow_output_mutation=True)
+def get_scatter(digest, commodity, y, name, min_cutoff, max_cutoff, trendline, label_by):
+    ds = get_dataset(digest)
+    rows = queries.select(ds, commodity, min_cutoff, max_cutoff, label_by)
+    fits = queries.trendline_fits(ds, commodity, y, min_cutoff, max_cutoff, trendline, label_by) if trendline else None
+    return charts.scatter(rows, y, name, label_by, fits)
 
-def format_df_col(df, col):
-    col_values = format_col(df, col)
-    df[col] = col_values
-    df = df[df[col].notna()]
-    return df
+@st.cache(show_spinner=False, max_entries=64, allow_output_mutation=True)
+def get_geo_figures(digest, commodity, col, label):  # (map, bar chart) of the average per country
+    data = queries.group_stats(get_dataset(digest), commodity, col, 'Country')['mean']
+    return charts.geo(data, col, label, commodity), charts.bar(data, label, commodity)
 
-def format_fig(fig):
-    fig.update_layout(
-        font_family="IBM Plex Sans",
-        font_color="black",
-        title_font_family="IBM Plex Sans",
-        title_font_color="black",
-        legend_title_font_color="black")
-    fig.update_xaxes(title_font_family="IBM Plex Sans")
-    fig.update_yaxes(title_font_family="IBM Plex Sans")
-    return fig
+digest = queries.current_digest()  # the same check the JSON API uses for a changed spreadsheet
+ds = get_dataset(digest)
+parse_failures = ds.parse_failures  # don't modify these, they are shared between reruns
 
-full_df = get_full_df()
-
-# Get Row Ranges for Commodities
-rows = full_df[full_df.iloc[:, 0].notna()].iloc[:, 1]
-
-commodity_rows = {
-    commodity: (start, end)
-    for start, end, commodity in zip(rows.index, rows.index[1:], rows)
-}
-commodity_rows['Tuna'] = (507, 600) #596, 586
 # Select the commodity to analyze
-commodity = st.sidebar.selectbox(label='Select a Commodity', options=list(commodity_rows.keys()))
-start, end = commodity_rows[commodity]
-df_filtered = full_df[start:end].dropna(axis=0, subset=['Reference'])
-numerical_cols = ['GHG Emissions', 'Land Use', 'Eutrophication Potential', 
-                'Acidification Potential', 'Freshwater Withdrawal']
-
-col_labels = [  # Tuples of (column name, pretty print name for axis labels)
-    ('Land Use','Land Use (m<sup>2</sup>*yr)'),
-    ('Eutrophication Potential', 'Eutrophication Potential (kg PO<sub>4</sub><sup>3-</sup> eq.)'),
-    ('Acidification Potential', 'Acidification Potential (kg SO<sub>2</sub> eq.)'),
-    ('Freshwater Withdrawal', 'Freshwater Withdrawal (L)')
-    ]
-col_labels_dict = {'GHG Emissions': 'GHG Emissions (kg CO<sub>2</sub> eq.)',
-    'Land Use': 'Land Use (m<sup>2</sup>*yr)',
-    'Eutrophication Potential': 'Eutrophication Potential (kg PO<sub>4</sub><sup>3-</sup> eq.)',
-    'Acidification Potential': 'Acidification Potential (kg SO<sub>2</sub> eq.)',
-    'Freshwater Withdrawal': 'Freshwater Withdrawal (L)'}
+commodity = st.sidebar.selectbox(label='Select a Commodity', options=queries.commodities(ds))
+df_filtered = ds.frames[commodity]
+numerical_cols = data_store.numerical_cols
 
-indicators = ['Land Use', 'Eutrophication Potential', 
-    'Acidification Potential', 'Freshwater Withdrawal']
+col_labels_dict = charts.indicator_labels
+indicators = charts.indicators
+col_labels = [(col, col_labels_dict[col]) for col in indicators]  # Tuples of (column name, pretty print name for axis labels)
 web_links = {'Maize' : 'https://agimpacts.wpengine.com/plants/maize/',
     'Palm Oil' : 'https://agimpacts.wpengine.com/plants/palm-oil/',
     'Soybeans' : 'https://agimpacts.wpengine.com/plants/soybeans/',
@@ -83,66 +56,106 @@ web_links = {'Maize' : 'https://agimpacts.wpengine.com/plants/maize/',
     }
 ghg = 'GHG Emissions'
 
-with st.beta_expander('Impact Analysis'):
+def lazy_section(label, render, key):
+    # Streamlit doesn't tell us whether an expander is open, so each section's work is wrapped
+    # in a function that only runs once the section is switched on. Its figures, fits and
+    # statistics are cached by their inputs, so reruns of an unchanged section reuse them.
+    with st.beta_expander(label):
+        if st.checkbox(f'Load {label}', key=key):
+            render()
+        else:
+            st.markdown('Tick the box above to load this section.')
+
+def table_rows(digest, commodity, low=None, high=None):
+    # every row of the commodity, or only those in a GHG range (sorted by GHG emissions)
+    ds = get_dataset(digest)
+    return ds.frames[commodity] if low is None else queries.select(ds, commodity, low, high)
+
+# The download file is built once per selection and reused while other widgets change, so
+# slider drags and paging don't re-serialize the whole selection.
+@st.cache(show_spinner=False, max_entries=8, allow_output_mutation=True)
+def get_download(digest, commodity, low, high, columns, sort_by, descending, search, file_format):
+    rows = table_rows(digest, commodity, low, high)
+    positions = queries.table_positions(rows, sort_by, not descending, search)
+    if file_format == 'CSV':
+        return ''.join(queries.csv_chunks(rows, positions, list(columns)))
+    return queries.parquet_bytes(rows, positions, list(columns))
+
+def paged_table(key, commodity, low=None, high=None, columns=None, file_name='agimpacts_data'):
+    # Sorting, searching and paging happen here on the server, so only the visible page of
+    # rows is turned into a table and sent to the browser instead of the whole selection.
+    rows = table_rows(digest, commodity, low, high)
+    columns = list(rows.columns) if columns is None else columns
+    sort_col, order_col, search_col, size_col = st.beta_columns(4)
+    sort_by = sort_col.selectbox('Sort by', ['(none)'] + columns, key=f'{key}_sort')
+    descending = order_col.checkbox('Descending', key=f'{key}_descending')
+    search = search_col.text_input('Search text columns', key=f'{key}_search')
+    page_size = size_col.selectbox('Rows per page', [25, 50, 100, 250], key=f'{key}_page_size')
+    sort_by = None if sort_by == '(none)' else sort_by
+    positions = queries.table_positions(rows, sort_by, not descending, search)
+    pages = max(1, -(-len(positions) // page_size))
+    page = st.number_input(f'Page (of {pages})', min_value=1, max_value=pages, value=1, step=1, key=f'{key}_page')
+    start = (int(page) - 1) * page_size
+    st.dataframe(queries.table_page(rows, positions, start, page_size, columns))
+    st.markdown(f'Showing rows {min(start + 1, len(positions))} to {min(start + page_size, len(positions))} of {len(positions)}.')
+    if st.checkbox('Download all matching rows', key=f'{key}_download'):  # only build the file when asked
+        file_format = st.radio('File format', ['CSV', 'Parquet'], key=f'{key}_format')
+        with st.spinner('Preparing download...'):
+            data = get_download(digest, commodity, low, high, tuple(columns), sort_by, descending, search, file_format)
+        if file_format == 'CSV':
+            st.download_button('Download CSV', data, file_name=f'{file_name}.csv', mime='text/csv', key=f'{key}_csv')
+        else:
+            st.download_button('Download Parquet', data, file_name=f'{file_name}.parquet', mime='application/octet-stream', key=f'{key}_parquet')
+
+def impact_analysis():
     trendline_dict = {
         'Linear Trendline': 'ols',
         'Non-Linear Trendline': 'lowess',
         'None' : None
         }
-    ghg_col = format_col(df_filtered, ghg)
-    df_filtered[ghg] = ghg_col
-    ghg_points = sorted(set(ghg_col))
+    ghg_points = queries.ghg_stops(ds, commodity)
     min_cutoff, max_cutoff = st.select_slider('Select a range of GHG emissions', ghg_points, value=(min(ghg_points), max(ghg_points)))
     st.markdown(f'Your selected range is from {min_cutoff} (kg CO<sub>2</sub> eq) to {max_cutoff} (kg CO<sub>2</sub> eq).', unsafe_allow_html=True)
-    cutoff_df = df_filtered.loc[(df_filtered[ghg] <= max_cutoff) & (df_filtered[ghg] >= min_cutoff) & (df_filtered[ghg] >= 0.0), ['GHG Emissions', 'Land Use', 'Eutrophication Potential', 
-    'Acidification Potential', 'Freshwater Withdrawal', 'Country', 'System']] # for some reason >= 0 isn't working
+    cutoff_df = queries.select(ds, commodity, min_cutoff, max_cutoff)  # rows sorted by GHG emissions
     show_data = st.checkbox('Show Filtered Raw Data')
     if show_data:
-        st.dataframe(cutoff_df)
+        paged_table('filtered', commodity, min_cutoff, max_cutoff, columns=queries.table_cols, file_name=f'{commodity} filtered data')
     show_quantiles = st.checkbox('Show Quantiles of GHG Emissions')
     if show_quantiles:
-            quantile_list = df_filtered[ghg].quantile([0.25,0.5,0.75, 1.0])
-            quantile_list = pd.DataFrame(quantile_list)
+            ghg_stats = queries.full_range_stats(ds, commodity, ghg)
+            quantile_list = pd.DataFrame({ghg: ghg_stats[['25%', '50%', '75%', 'max']].values}, index=[0.25, 0.5, 0.75, 1.0])
             st.dataframe(quantile_list)
     options = st.selectbox(
         'Select Trendline',
         ['Linear Trendline', 'Non-Linear Trendline', 'None'], index=2)
     features = st.multiselect('Select Additional Features', ['Label by Country', 'Label by System Type', 'Display Median and Average', 'Display Advanced Statistics'
     ])
+    label_by = tuple(label for label, feature in (('Country', 'Label by Country'), ('System', 'Label by System Type')) if feature in features)
+    trendline = trendline_dict[options]
     for y, name in col_labels:
-        df_filtered[y] = format_col(df_filtered, y)
-        cutoff_df[y] = format_col(cutoff_df, y)
-        if 'Label by Country' in features:
-            cutoff_df = format_df_col(cutoff_df, 'Country')
-        if 'Label by System Type' in features:
-            cutoff_df = format_df_col(cutoff_df, 'System')
         empty_graph = cutoff_df[y].isnull().values.all() or cutoff_df[ghg].isnull().values.all()
         if empty_graph:
             st.markdown(f'A graph for {name} cannot be generated because there is no data for this indicator.', unsafe_allow_html = True)
         elif not empty_graph:
-            fig = px.scatter(x=cutoff_df['GHG Emissions'],
-                        template='simple_white',
-                y=cutoff_df[y]
-                , color= cutoff_df['Country'] if 'Label by Country' in features else None
-                , symbol = cutoff_df['System'] if 'Label by System Type' in features else None
-                , title=f'{name} vs. GHG Emissions (kg CO<sub>2</sub> eq)',
-                labels={'x': 'GHG Emissions (kg CO<sub>2</sub> eq)', 'y':name, 'color' : 'Country', 'symbol' : 'System'}
-                , trendline = trendline_dict[options]
-                )
-            fig = format_fig(fig)
+            fig = get_scatter(digest, commodity, y, name, min_cutoff, max_cutoff, trendline, label_by)
             st.plotly_chart(fig)
             if 'Display Median and Average' in features:
                 try:
-                    st.markdown(f'The median {name} for your selected range is {round(cutoff_df[y].median(), 5)}, compared to {round(df_filtered[y].median(skipna=True), 5)} for the full range, and the average is {round(cutoff_df[y].mean(), 5)}, compared to {round(df_filtered[y].mean(skipna=True), 5)} for the full range.', unsafe_allow_html=True)
+                    full_range = queries.full_range_stats(ds, commodity, y)
+                    st.markdown(f'The median {name} for your selected range is {round(cutoff_df[y].median(), 5)}, compared to {round(full_range["50%"], 5)} for the full range, and the average is {round(cutoff_df[y].mean(), 5)}, compared to {round(full_range["mean"], 5)} for the full range.', unsafe_allow_html=True)
                 except:
                     st.markdown(f'The median {name} for your selected range is {round(cutoff_df[y].median(), 5)}, and the average is {round(cutoff_df[y].mean(), 5)}.', unsafe_allow_html=True)
                     st.markdown('Due to an error, the compared median and average cannot be displayed for this chart.')
             if 'Display Advanced Statistics' in features and (options == 'Linear Trendline') and empty_graph == False and cutoff_df[y].describe().loc['count']>5:
                 try:
-                    results = px.get_trendline_results(fig)
-                    results_table = results.px_fit_results.iloc[0].summary().tables[1]
-                    st.markdown(f'#### Statistical Values for {name} vs. GHG Emissions (kg CO<sub>2</sub> eq)', unsafe_allow_html=True)
-                    st.dataframe(results_table)
+                    fits = queries.trendline_fits(ds, commodity, y, min_cutoff, max_cutoff, trendline, label_by)
+                    # the first trace that has a fit; groups with a single GHG value don't get one
+                    fit = next((fits[trace.name or ''] for trace in fig.data if fits.get(trace.name or '') is not None), None)
+                    if fit is None:
+                        st.markdown('There is not enough data to display advanced statistics.')
+                    else:
+                        st.markdown(f'#### Statistical Values for {name} vs. GHG Emissions (kg CO<sub>2</sub> eq)', unsafe_allow_html=True)
+                        st.dataframe(fit.table)
                 except:
                     pass
             elif 'Display Advanced Statistics' in features and empty_graph == False and cutoff_df[y].describe().loc['count']>5:
@@ -150,38 +163,31 @@ with st.beta_expander('Impact Analysis'):
             elif 'Display Advanced Statistics' in features:
                 st.markdown('There is not enough data to display advanced statistics.')
 
-with st.beta_expander('Geographic Analysis'):
+def geographic_analysis():
     st.markdown('This tool analyzes indicators by geographic region.')
     col = st.selectbox(label='Indicator to Analyze', options=numerical_cols)
-    df_filtered[col] = format_col(df_filtered, col)
-    # df_filtered = df_filtered.sort_values(by=col, ascending=False)
-    data = df_filtered.groupby('Country')[col].mean()
-    empty_graph = df_filtered[col].isnull().values.all() 
+    empty_graph = queries.full_range_stats(ds, commodity, col)['count'] == 0
     if empty_graph:
         st.markdown(f'Graphs for {col} cannot be generated because there is no data for this indicator.', unsafe_allow_html = True)
     elif not empty_graph:
-        fig = px.scatter_geo(size=data.fillna(0), locations=data.index, locationmode='country names',
-                            title=f'Global {col_labels_dict[col]} for {commodity}', labels={'locations': 'Country', 'size': col}, 
-                            #  width=1500, height=600
-                            template='simple_white')
-        fig = format_fig(fig)
-        st.plotly_chart(fig)
-        data.sort_values(ascending=False, inplace=True)  # this sorts countries from greatest to least instead of alphabetically!
-        fig = px.bar(x=data.index, y=data.fillna(0), title=f'{col_labels_dict[col]} vs. Country for {commodity}',
-                    labels={'x': 'Country', 'y': col_labels_dict[col]}, 
-                    #  width=1500, height=600, 
-                    template='simple_white')
-        fig = format_fig(fig)
-        st.plotly_chart(fig)
-commodity_raw_data = f'Raw Data for {commodity}'
-with st.beta_expander(commodity_raw_data):
+        map_fig, bar_fig = get_geo_figures(digest, commodity, col, col_labels_dict[col])
+        st.plotly_chart(map_fig)
+        st.plotly_chart(bar_fig)  # countries from greatest to least instead of alphabetically
+def raw_data():
     st.markdown('[See the original data sources here.](https://github.com/anushreechaudhuri/agimpacts/blob/master/AgImpacts_Data_Sources.md)', unsafe_allow_html=True)
-    st.dataframe(df_filtered)
+    paged_table('raw', commodity, file_name=f'{commodity} raw data')
+    unreadable = parse_failures.loc[df_filtered.index]
+    if unreadable.values.any():
+        st.markdown(f'Note: {unreadable.values.sum()} values in the spreadsheet for {commodity} could not be read as numbers and are shown as blank ({", ".join(unreadable.columns[unreadable.any()])}).')
+lazy_section('Impact Analysis', impact_analysis, key='impact_analysis')
+lazy_section('Geographic Analysis', geographic_analysis, key='geographic_analysis')
+commodity_raw_data = f'Raw Data for {commodity}'
+lazy_section(commodity_raw_data, raw_data, key='raw_data')
 with st.beta_expander('Tool Usage Guide'):
-    st.markdown('This is a tool for exploratory analysis. First, select a commodity in the left sidebar. Next, click on a section of interest. The purpose of each section is described below:')
+    st.markdown('This is a tool for exploratory analysis. First, select a commodity in the left sidebar. Next, click on a section of interest and tick its Load box. The purpose of each section is described below:')
     st.markdown('* **Impact Analysis** displays scatter plots of each environmental indicator vs. GHG emissions, with features allowing for selection of a range of GHG emissions, a linear and non-linear trendline, labeling by country and/or system, and displaying the median, average, and advanced statistics for each chart.')
     st.markdown('* **Geographic Analysis** first displays a map plot of a selected indicator by country, with the size of each circle reflecting the average magnitude of the indicator in that country. Next, it displays a bar graph showing the average indicator value by country, ordered from highest to lowest magnitude to easily identify countries with high average environmental impact from a selected indicator.')
-    st.markdown(f'* **Raw Data for {commodity}** displays an interactive table of raw data for the selected commodity and a link to view and download our original data soures. To read more about the selected commodity, including interpretation and takeaways from the data, click the link below this section.', unsafe_allow_html=True)
+    st.markdown(f'* **Raw Data for {commodity}** displays an interactive table of raw data for the selected commodity, which can be sorted, searched, paged through and downloaded as CSV or Parquet, and a link to view and download our original data soures. To read more about the selected commodity, including interpretation and takeaways from the data, click the link below this section.', unsafe_allow_html=True)
     st.text('')
     st.markdown('All charts in this web tool are interactive. Useful features include zooming in and out, filtering by label to isolate a country or system of interest, hovering to see details on each data point and trendline, and downloading any plot as a png. Tables are also interactive; each column can be filtered and sorted. For a more in-depth tutorial on using this tool, including a walk-through of the interactive chart features, watch the screencasts linked below.')
     st.markdown('#### Watch Screencasts on Using This Tool: [Part 1](https://www.loom.com/share/580b27050b4249759bf82dd7aad80e80) | [Part 2](https://www.loom.com/share/8aba913be3134e0b9a6e32a76b1d33c2)', unsafe_allow_html=True)
@@ -0,0 +1,250 @@
+"""Benchmarks for the web tool's data and chart code paths.
+
+Runs scripted interactions (switching commodity, dragging the GHG slider, toggling
+trendlines and labels, changing the geographic indicator) through the same functions the
+web tool calls. It reports time, peak memory and payload size for each phase. Peak
+memory is measured three ways: Python allocations (tracemalloc), Arrow's allocations and
+the process's resident set size, the last two sampled every millisecond, since
+tracemalloc cannot see pyarrow's or numpy's native buffers. Synthetic datasets repeat
+every commodity's rows (with a little noise on GHG emissions) to show how each phase
+scales.
+
+    python benchmark.py --scale 1 10 100 --json bench.json
+
+Caches are bypassed, so every number is the cost of a cold rerun. LOWESS fits grow
+quadratically with the number of rows; pass --trendline ols for the largest scales.
+"""
+import argparse
+import contextlib
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+import charts
+import data_store
+import queries
+import trendlines
+
+ghg = 'GHG Emissions'
+page_size = 25  # rows per page of the web tool's tables
+
+
+def current_rss():
+    # resident set size from /proc; 0 where that isn't available
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return 0
+
+
+class Sampler(threading.Thread):
+    """Polls RSS and Arrow's allocated bytes while a phase runs and keeps the highest."""
+
+    def __init__(self, interval=0.001):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.done = threading.Event()
+        self.rss = self.rss_baseline = current_rss()
+        self.arrow = self.arrow_baseline = pa.total_allocated_bytes()
+
+    def sample(self):
+        self.rss = max(self.rss, current_rss())
+        self.arrow = max(self.arrow, pa.total_allocated_bytes())
+
+    def run(self):
+        while not self.done.wait(self.interval):
+            self.sample()
+
+    def stop(self):
+        # (RSS growth, Arrow growth) at the phase's peak
+        self.done.set()
+        self.join()
+        self.sample()
+        return self.rss - self.rss_baseline, self.arrow - self.arrow_baseline
+
+
+class Phases:
+    """Accumulates time, peak memory and payload bytes per phase."""
+
+    def __init__(self, trace_memory=True):
+        self.trace_memory = trace_memory
+        self.results = {}
+
+    def result(self, phase):
+        return self.results.setdefault(phase, {'calls': 0, 'seconds': 0.0, 'peak_bytes': 0, 'arrow_peak_bytes': 0,
+                                               'rss_peak_bytes': 0, 'payload_bytes': 0})
+
+    @contextlib.contextmanager
+    def measure(self, phase):
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+            baseline = tracemalloc.get_traced_memory()[0]
+            sampler = Sampler()
+            sampler.start()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            result = self.result(phase)
+            result['seconds'] += time.perf_counter() - start
+            result['calls'] += 1
+            if self.trace_memory:
+                rss, arrow = sampler.stop()
+                peak = tracemalloc.get_traced_memory()[1] - baseline
+                result['peak_bytes'] = max(result['peak_bytes'], peak)
+                result['arrow_peak_bytes'] = max(result['arrow_peak_bytes'], arrow)
+                result['rss_peak_bytes'] = max(result['rss_peak_bytes'], rss)
+
+    def payload(self, phase, nbytes):
+        self.result(phase)['payload_bytes'] += nbytes
+
+
+def scale_raw(raw, factor, seed=0):
+    """Repeat the data rows of every commodity section factor times."""
+    if factor == 1:
+        return raw
+    rng = np.random.default_rng(seed)
+    bounds = list(np.flatnonzero(raw.iloc[:, 0].notna().to_numpy())) + [len(raw)]
+    parts = [raw.iloc[:bounds[0]]]
+    for start, end in zip(bounds, bounds[1:]):
+        rows = pd.concat([raw.iloc[start + 1:end]] * factor, ignore_index=True)
+        # spread GHG values out so the slider gets more distinct stops, like real new data would
+        rows[ghg] = rows[ghg] * rng.lognormal(0.0, 0.1, len(rows))
+        parts += [raw.iloc[start:start + 1], rows]
+    return pd.concat(parts, ignore_index=True)
+
+
+def arrow_bytes(df):
+    # st.dataframe sends tables to the browser as Arrow IPC
+    table = pa.Table.from_pandas(df)
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().size
+
+
+def emit(phases, fig):
+    with phases.measure('serialization'):
+        payload = fig.to_json()
+    phases.payload('serialization', len(payload))
+
+
+def run_ingest(phases, raw, path, scale):
+    if scale == 1:
+        with phases.measure('xlsx load'):
+            data_store.read_workbook(path)
+    with phases.measure('cleaning'):
+        full_df, failures = data_store.clean_df(raw)
+    with tempfile.TemporaryDirectory() as tmp:
+        target = os.path.join(tmp, 'clean.feather')
+        with phases.measure('artifact write'):
+            data_store.write_artifact(full_df, failures, target)
+        with phases.measure('artifact load'):
+            full_df, failures = data_store.read_artifact(target)
+    with phases.measure('indexing'):
+        return queries.Dataset(full_df, failures)
+
+
+def run_interactions(phases, ds, commodity, kinds, drags, seed=0):
+    rng = random.Random(seed)
+    # switch through every commodity
+    for name in queries.commodities(ds):
+        with phases.measure('filtering'):
+            stops = queries.ghg_stops(ds, name)
+            rows = queries.select(ds, name)
+        with phases.measure('table serialization'):
+            positions = queries.table_positions(rows)
+            page = queries.table_page(rows, positions, 0, page_size, queries.table_cols)
+            phases.payload('table serialization', arrow_bytes(page))
+    # drag the GHG slider
+    stops = queries.ghg_stops(ds, commodity)
+    for _ in range(drags):
+        low, high = sorted(rng.sample(stops, 2)) if len(stops) > 1 else (stops[0], stops[0])
+        with phases.measure('filtering'):
+            queries.select(ds, commodity, low, high)
+    # toggle trendlines and labels on every indicator
+    for kind in kinds:
+        for label_by in ((), ('Country',), ('Country', 'System')):
+            rows = queries.select(ds, commodity, label_by=label_by)
+            for y in charts.indicators:
+                fits = None
+                if kind:
+                    with phases.measure('fitting'):
+                        fits = trendlines.fit_groups(rows, ghg, y, kind, by=label_by)
+                with phases.measure('figure build'):
+                    fig = charts.scatter(rows, y, charts.indicator_labels[y], label_by, fits)
+                emit(phases, fig)
+    # change the geographic indicator
+    for col in data_store.numerical_cols:
+        with phases.measure('aggregation'):
+            data = queries.group_stats(ds, commodity, col)['mean']
+        with phases.measure('figure build'):
+            figs = charts.geo(data, col, charts.indicator_labels[col], commodity), \
+                charts.bar(data, charts.indicator_labels[col], commodity)
+        for fig in figs:
+            emit(phases, fig)
+    # open the raw data table, sorted by GHG emissions
+    rows = ds.frames[commodity]
+    with phases.measure('table serialization'):
+        positions = queries.table_positions(rows, ghg, ascending=False)
+        phases.payload('table serialization', arrow_bytes(queries.table_page(rows, positions, 0, page_size)))
+
+
+def run(raw, path, scale, commodity, kinds, drags, trace_memory):
+    raw = scale_raw(raw, scale)
+    phases = Phases(trace_memory)
+    if trace_memory:
+        tracemalloc.start()
+    try:
+        ds = run_ingest(phases, raw, path, scale)
+        run_interactions(phases, ds, commodity, kinds, drags)
+    finally:
+        if trace_memory:
+            tracemalloc.stop()
+    return [dict(scale=scale, rows=len(raw), phase=phase, **result) for phase, result in phases.results.items()]
+
+
+def report(results):
+    print(f"{'scale':>6} {'rows':>8}  {'phase':<20} {'calls':>5} {'seconds':>9} {'py MB':>8} {'arrow MB':>8} "
+          f"{'rss MB':>8} {'payload KB':>10}")
+    for r in results:
+        print(f"{r['scale']:>6} {r['rows']:>8}  {r['phase']:<20} {r['calls']:>5} {r['seconds']:>9.3f} "
+              f"{r['peak_bytes'] / 2**20:>8.1f} {r['arrow_peak_bytes'] / 2**20:>8.1f} "
+              f"{r['rss_peak_bytes'] / 2**20:>8.1f} {r['payload_bytes'] / 2**10:>10.1f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the AgImpacts web tool code paths.')
+    parser.add_argument('--data', default=data_store.DATA_FILE, help='raw data spreadsheet')
+    parser.add_argument('--scale', type=int, nargs='+', default=[1, 10, 100],
+                        help='repeat each commodity\'s rows this many times (one run per value)')
+    parser.add_argument('--commodity', default='Maize', help='commodity used for slider, trendline and map steps')
+    parser.add_argument('--trendline', nargs='+', default=['none', 'ols', 'lowess'],
+                        choices=['none', 'ols', 'lowess'], help='trendline settings to toggle through')
+    parser.add_argument('--drags', type=int, default=50, help='number of GHG slider moves')
+    parser.add_argument('--no-memory', action='store_true', help='skip memory measurement (faster, cleaner timings)')
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args(argv)
+
+    kinds = [None if kind == 'none' else kind for kind in args.trendline]
+    raw = data_store.read_workbook(args.data)
+    results = []
+    for scale in args.scale:
+        results += run(raw, args.data, scale, args.commodity, kinds, args.drags, not args.no_memory)
+    report(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+"""Plotly figures shared by the web tool and the graph generator.
+
+All figures use the 'agimpacts' template (simple_white with IBM Plex Sans titles), so
+they no longer need format_fig's update_layout/update_xaxes calls after they are built.
+"""
+import plotly.express as px
+import plotly.graph_objects as go
+import plotly.io as pio
+
+import data_store
+import trendlines
+
+FONT = 'IBM Plex Sans'
+pio.templates['agimpacts'] = go.layout.Template(layout=dict(
+    font=dict(family=FONT, color='black'),
+    title_font=dict(family=FONT, color='black'),
+    legend_title_font_color='black',
+    xaxis_title_font_family=FONT,
+    yaxis_title_font_family=FONT))
+TEMPLATE = 'simple_white+agimpacts'
+
+ghg_label = 'GHG Emissions (kg CO<sub>2</sub> eq)'
+indicator_labels = {  # pretty print names for axis labels
+    'GHG Emissions': 'GHG Emissions (kg CO<sub>2</sub> eq.)',
+    'Land Use': 'Land Use (m<sup>2</sup>*yr)',
+    'Eutrophication Potential': 'Eutrophication Potential (kg PO<sub>4</sub><sup>3-</sup> eq.)',
+    'Acidification Potential': 'Acidification Potential (kg SO<sub>2</sub> eq.)',
+    'Freshwater Withdrawal': 'Freshwater Withdrawal (L)'}
+indicators = [col for col in data_store.numerical_cols if col != 'GHG Emissions']  # plotted against GHG
+
+
+def scatter(rows, y, name, label_by=(), fits=None):
+    """Indicator vs. GHG Emissions, optionally labelled and with cached trendline fits."""
+    fig = px.scatter(x=rows['GHG Emissions'], y=rows[y],
+                     color=rows['Country'] if 'Country' in label_by else None,
+                     symbol=rows['System'] if 'System' in label_by else None,
+                     title=f'{name} vs. {ghg_label}',
+                     labels={'x': ghg_label, 'y': name, 'color': 'Country', 'symbol': 'System'},
+                     template=TEMPLATE)
+    if fits:
+        fig = trendlines.add_trendlines(fig, fits)
+    return fig
+
+
+def geo(data, col, label, commodity):
+    """Map of the average indicator value per country (data is indexed by country)."""
+    return px.scatter_geo(size=data.fillna(0), locations=data.index, locationmode='country names',
+                          title=f'Global {label} for {commodity}',
+                          labels={'locations': 'Country', 'size': col}, template=TEMPLATE)
+
+
+def bar(data, label, commodity):
+    """Average indicator value per country, from greatest to least."""
+    data = data.sort_values(ascending=False)
+    return px.bar(x=data.index, y=data.fillna(0), title=f'{label} vs. Country for {commodity}',
+                  labels={'x': 'Country', 'y': label}, template=TEMPLATE)
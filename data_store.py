@@ -0,0 +1,252 @@
+"""Ingest step for the AgImpacts raw data spreadsheet.
+
+Parsing AgImpacts_Raw_Data.xlsx through openpyxl and cleaning its indicator columns are
+the slowest parts of starting the web tool, so the workbook is converted once into an
+uncompressed Feather file named after the sha256 of the workbook. The file holds the
+cleaned sheet (indicator columns as float64) and the mask of cells that could not be
+parsed. Later loads memory-map that file instead of re-reading the spreadsheet, and a
+new file is only built when the workbook changes.
+
+Run `python data_store.py` to build the file ahead of time (e.g. when deploying).
+"""
+import contextlib
+import glob
+import hashlib
+import os
+import re
+import tempfile
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+
+DATA_FILE = 'AgImpacts_Raw_Data.xlsx'
+CACHE_DIR = '.agimpacts_cache'
+
+numerical_cols = ['GHG Emissions', 'Land Use', 'Eutrophication Potential',
+                'Acidification Potential', 'Freshwater Withdrawal']
+label_cols = ['Country', 'System']
+# thousands separators, percent signs and (non-breaking) spaces; '-' is the sheet's
+# placeholder for missing data, so it is only dropped when it is the whole cell
+number_junk = re.compile(r'[,%\s\xa0]')
+missing_values = ('', '-')
+number_pattern = r'[+-]?(\d+\.?\d*|\.\d+)([eE][+-]?\d+)?'
+# the parse-failure mask is stored next to the cleaned columns under these names
+failure_prefix = 'parse failed: '
+artifact_version = 3  # bump when the artifact's contents change, so old files are rebuilt
+
+# frame: rows with a non-negative GHG value, sorted by GHG; values: their sorted GHG
+# values; stops: every distinct GHG value (including negative ones) for the range slider
+GhgIndex = namedtuple('GhgIndex', ['frame', 'values', 'stops'])
+
+
+def workbook_hash(path=DATA_FILE):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def artifact_path(digest, path=DATA_FILE, cache_dir=None):
+    # the cache lives next to the workbook unless told otherwise
+    cache_dir = cache_dir or os.path.join(os.path.dirname(path), CACHE_DIR)
+    name = os.path.splitext(os.path.basename(path))[0]
+    return os.path.join(cache_dir, f'{name}-{digest[:16]}-v{artifact_version}.feather')
+
+
+def read_workbook(path=DATA_FILE):
+    full_df = pd.read_excel(path, sheet_name=1, header=1)
+    full_df.columns = [str(col) for col in full_df.columns]
+    return full_df
+
+
+def indicator_cols(full_df):
+    # every column from GHG Emissions onwards holds a numeric indicator
+    cols = list(full_df.columns)
+    return cols[cols.index('GHG Emissions'):]
+
+
+def clean_numeric(values):
+    """Parse one column into float64 in a single pass.
+
+    Returns the parsed column and a boolean mask of the cells that held something
+    other than a number or a missing-data placeholder (e.g. '####').
+    """
+    if values.dtype.kind in 'fiub':
+        return values.astype(float), pd.Series(False, index=values.index)
+    values = values.astype(object)
+    is_text = values.map(lambda value: isinstance(value, str)).to_numpy(dtype=bool)
+    # numbers in the sheet are kept exactly; only the text cells are stripped and parsed
+    parsed = pd.to_numeric(values.where(~is_text), errors='coerce').astype(float)
+    text = values[is_text].str.replace(number_junk, '', regex=True)
+    # astype(float) parses exactly, pd.to_numeric's fast parser can lose the last digit
+    numbers = text[text.str.fullmatch(number_pattern)]
+    parsed[numbers.index] = numbers.astype(float)
+    failures = parsed.isna() & values.notna()
+    failures[is_text] &= ~text.isin(missing_values)
+    return parsed, failures
+
+
+def clean_df(full_df, cols=None):
+    """Return a copy of full_df with every indicator column parsed to float64.
+
+    Country and System labels are stripped and '-' placeholders become NaN. The
+    second return value is a per-cell mask (indicator columns only) of cells that
+    could not be parsed, for auditing the spreadsheet.
+    """
+    cols = indicator_cols(full_df) if cols is None else cols
+    cleaned = full_df.copy()
+    failures = {}
+    for col in cols:
+        cleaned[col], failures[col] = clean_numeric(full_df[col])
+    for col in label_cols:
+        labels = full_df[col].astype(object).where(full_df[col].notna(), None).str.strip()
+        cleaned[col] = labels.where(~labels.isin(missing_values))
+    return cleaned, pd.DataFrame(failures, index=full_df.index)
+
+
+def commodity_frames(full_df):
+    """Split the sheet into one frame per commodity section.
+
+    A section starts at a row with a number in the first column and the commodity
+    name under Reference, and runs until the next section (or the end of the sheet).
+    The heading row itself and rows without a Reference are left out.
+    """
+    headings = full_df[full_df.iloc[:, 0].notna()].iloc[:, 1]
+    starts = [full_df.index.get_loc(i) for i in headings.index]
+    ends = starts[1:] + [len(full_df)]
+    frames = {}
+    for commodity, start, end in zip(headings, starts, ends):
+        section = full_df.iloc[start + 1:end]
+        frames[commodity.strip()] = section.dropna(axis=0, subset=['Reference']).copy()
+    return frames
+
+
+def ghg_index(frame, col='GHG Emissions'):
+    ghg = frame[col].to_numpy(dtype=float)
+    order = np.argsort(ghg, kind='stable')
+    order = order[~np.isnan(ghg[order])]  # NaN sorts last
+    values = ghg[order]
+    stops = np.unique(values).tolist()
+    keep = values >= 0.0
+    return GhgIndex(frame.iloc[order[keep]], values[keep], stops)
+
+
+def ghg_range(index, low, high):
+    """Rows of index.frame with low <= GHG <= high (and GHG >= 0), as a slice."""
+    start = index.values.searchsorted(max(low, 0.0), side='left')
+    end = index.values.searchsorted(high, side='right')
+    return index.frame.iloc[start:end]
+
+
+def describe_groups(frame, by=None, cols=numerical_cols):
+    # one row per (group, indicator) with the columns of describe(): count, mean, std,
+    # min, 25%, 50% (the median), 75% and max
+    keys = frame[by] if by is not None else pd.Series('', index=frame.index)
+    grouped = frame[cols].groupby(keys.rename('group'))
+    stats = {
+        'count': grouped.count(), 'mean': grouped.mean(), 'std': grouped.std(),
+        'min': grouped.min(), '25%': grouped.quantile(0.25), '50%': grouped.median(),
+        '75%': grouped.quantile(0.75), 'max': grouped.max()}
+    by_indicator = {col: pd.DataFrame({stat: values[col] for stat, values in stats.items()})
+                    for col in cols}
+    stats = pd.concat(by_indicator, names=['indicator', 'group']).swaplevel()
+    return stats.astype(float)
+
+
+def aggregate_cube(frames, cols=numerical_cols):
+    """Summary statistics for every commodity x (all rows, Country, System) x indicator.
+
+    The index levels are commodity, by ('All', 'Country' or 'System'), group (the
+    country or system, '' for 'All') and indicator; the columns are those of describe().
+    """
+    parts = {}
+    for commodity, frame in frames.items():
+        parts[(commodity, 'All')] = describe_groups(frame, None, cols)
+        for by in label_cols:
+            parts[(commodity, by)] = describe_groups(frame, by, cols)
+    cube = pd.concat(parts, names=['commodity', 'by', 'group', 'indicator'])
+    return cube.sort_index()
+
+
+def cube_slice(cube, commodity, by, indicator):
+    """Statistics for one commodity, grouping and indicator, indexed by group."""
+    levels = ['commodity', 'by', 'indicator']
+    try:
+        return cube.xs((commodity, by, indicator), level=levels)
+    except KeyError:  # e.g. a commodity without any System labels
+        return cube.iloc[:0].droplevel(levels)
+
+
+def arrow_table(full_df, failures):
+    columns = {}
+    for col in full_df.columns:
+        values = full_df[col]
+        if values.dtype.kind == 'f':
+            # keep NaN as a float value rather than an Arrow null, so loading the column
+            # is a view of the memory-mapped file instead of a copy
+            columns[col] = pa.array(values.to_numpy(), from_pandas=False)
+        elif values.dtype == object:
+            # Arrow needs one type per column, so other columns mixing numbers with text
+            # are stored as text; missing cells stay missing
+            columns[col] = pa.array(values.where(values.isna(), values.astype(str)), from_pandas=True)
+        else:
+            columns[col] = pa.array(values, from_pandas=True)
+    for col in failures.columns:
+        columns[failure_prefix + col] = pa.array(failures[col].to_numpy())
+    return pa.table(columns)
+
+
+def write_artifact(full_df, failures, target):
+    """Write a cleaned sheet and its parse-failure mask to target, atomically."""
+    cache_dir = os.path.dirname(target)
+    os.makedirs(cache_dir, exist_ok=True)
+    # write to a temporary file first so other workers never see a half-written file
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    os.close(fd)
+    try:
+        feather.write_feather(arrow_table(full_df, failures), tmp_path, compression='uncompressed')
+        os.replace(tmp_path, target)
+    finally:
+        with contextlib.suppress(FileNotFoundError):  # already moved into place
+            os.remove(tmp_path)
+
+
+def read_artifact(target):
+    # uncompressed + memory_map means the OS page cache is shared between workers;
+    # split_blocks keeps each float column a view of the file
+    table = feather.read_table(target, memory_map=True).to_pandas(split_blocks=True)
+    mask_cols = [col for col in table.columns if col.startswith(failure_prefix)]
+    failures = table[mask_cols].rename(columns=lambda col: col[len(failure_prefix):])
+    return table.drop(columns=mask_cols), failures
+
+
+def build_artifact(path=DATA_FILE, digest=None, cache_dir=None):
+    digest = digest or workbook_hash(path)
+    target = artifact_path(digest, path, cache_dir)
+    write_artifact(*clean_df(read_workbook(path)), target)
+    cache_dir = os.path.dirname(target)
+    # artifacts from older versions of the workbook are never read again; workers that
+    # start together all try to remove them, so one may already be gone
+    name = os.path.splitext(os.path.basename(path))[0]
+    for old in glob.glob(os.path.join(cache_dir, f'{name}-*.feather')):
+        if old != target:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(old)
+    return target
+
+
+def load_clean_df(path=DATA_FILE, digest=None, cache_dir=None):
+    """The cleaned sheet and its parse-failure mask, as returned by clean_df."""
+    digest = digest or workbook_hash(path)
+    target = artifact_path(digest, path, cache_dir)
+    if not os.path.exists(target):
+        build_artifact(path, digest, cache_dir)
+    return read_artifact(target)
+
+
+if __name__ == '__main__':
+    print(build_artifact())
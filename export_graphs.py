@@ -0,0 +1,192 @@
+"""Export the website's charts for every commodity in one run.
+
+This does what agimpacts-graph-generator.ipynb does for one commodity, for all of them:
+a scatter plot of each indicator vs. GHG emissions, and a map and a bar chart of the
+average of each indicator by country. Charts are rendered in parallel worker processes,
+and a manifest of input hashes in the output directory lets later runs skip every chart
+whose data and chart code have not changed.
+
+    python export_graphs.py --out graphs --format html svg --jobs 4
+
+Image formats (svg, png, pdf) are rendered with kaleido, which is in requirements.txt.
+"""
+import argparse
+import hashlib
+import importlib.util
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
+import plotly
+import plotly.graph_objects as go
+import plotly.io as pio
+
+import charts
+import data_store
+
+MANIFEST = 'manifest.json'
+chart_kinds = ('scatter', 'geo', 'bar')
+code_files = ('charts.py', 'trendlines.py', 'data_store.py', 'export_graphs.py')
+
+# loaded once per worker process by init_worker
+frames = None
+cube = None
+
+
+def load_data(path=data_store.DATA_FILE):
+    clean, _ = data_store.load_clean_df(path)
+    commodity_frames = data_store.commodity_frames(clean)
+    return commodity_frames, data_store.aggregate_cube(commodity_frames)
+
+
+def init_worker(path, formats):
+    global frames, cube
+    frames, cube = load_data(path)
+    if any(fmt != 'html' for fmt in formats):
+        start_renderer()
+
+
+def start_renderer():
+    # kaleido >= 1 renders through a browser; keep one running for this worker's charts
+    try:
+        import kaleido
+        kaleido.start_sync_server(silence_warnings=True)
+    except (ImportError, AttributeError):
+        pass
+    # older kaleido starts its subprocess on the first image and keeps it alive
+    pio.to_image(go.Figure(), format='svg')
+
+
+def chart_data(kind, commodity, col):
+    if kind == 'scatter':
+        return frames[commodity][['GHG Emissions', col]]
+    return data_store.cube_slice(cube, commodity, 'Country', col)[['mean']]
+
+
+def has_data(kind, commodity, col):
+    if kind == 'scatter':
+        return frames[commodity][[col, 'GHG Emissions']].notna().all(axis=1).any()
+    return data_store.cube_slice(cube, commodity, 'All', col).loc['', 'count'] > 0
+
+
+def make_figure(kind, commodity, col):
+    label = charts.indicator_labels[col]
+    if kind == 'scatter':
+        return charts.scatter(frames[commodity], col, label)
+    data = chart_data(kind, commodity, col)['mean']
+    if kind == 'geo':
+        return charts.geo(data, col, label, commodity)
+    return charts.bar(data, label, commodity)
+
+
+def tasks():
+    for commodity in frames:
+        for kind in chart_kinds:
+            for col in (charts.indicators if kind == 'scatter' else data_store.numerical_cols):
+                if has_data(kind, commodity, col):
+                    yield kind, commodity, col
+
+
+def output_name(kind, commodity, col, fmt):
+    names = {'scatter': f'{col} vs. GHG Emissions', 'geo': f'Map of {col} vs. Country',
+             'bar': f'Bar of {col} vs. Country'}
+    return os.path.join(commodity.replace('/', ''), f"{names[kind].replace('/', '')}.{fmt}")
+
+
+def code_hash():
+    digest = hashlib.sha256(plotly.__version__.encode())
+    here = os.path.dirname(os.path.abspath(__file__))
+    for name in code_files:
+        with open(os.path.join(here, name), 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def input_hash(kind, commodity, col, code):
+    digest = hashlib.sha256(f'{code}|{kind}|{commodity}|{col}'.encode())
+    digest.update(pd.util.hash_pandas_object(chart_data(kind, commodity, col)).values.tobytes())
+    return digest.hexdigest()
+
+
+def render(task, out_dir, formats):
+    kind, commodity, col = task
+    fig = make_figure(kind, commodity, col)
+    written = []
+    for fmt in formats:
+        path = os.path.join(out_dir, output_name(kind, commodity, col, fmt))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if fmt == 'html':
+            fig.write_html(path, include_plotlyjs='cdn')
+        else:
+            fig.write_image(path, format=fmt)
+        written.append(path)
+    return written
+
+
+def read_manifest(out_dir):
+    try:
+        with open(os.path.join(out_dir, MANIFEST)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def write_manifest(out_dir, manifest):
+    path = os.path.join(out_dir, MANIFEST)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+
+def main(argv=None):
+    global frames, cube
+    parser = argparse.ArgumentParser(description='Export AgImpacts charts for every commodity.')
+    parser.add_argument('--data', default=data_store.DATA_FILE, help='raw data spreadsheet')
+    parser.add_argument('--out', default='graphs', help='output directory')
+    parser.add_argument('--format', nargs='+', default=['html', 'svg'],
+                        choices=['html', 'svg', 'png', 'pdf'], help='file formats to write')
+    parser.add_argument('--commodity', nargs='+', help='only export these commodities')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(), help='worker processes')
+    parser.add_argument('--force', action='store_true', help='re-render unchanged charts too')
+    args = parser.parse_args(argv)
+    image_formats = [fmt for fmt in args.format if fmt != 'html']
+    if image_formats and importlib.util.find_spec('kaleido') is None:
+        # otherwise every worker dies on its first chart and the pool only reports BrokenProcessPool
+        parser.error(f"{', '.join(image_formats)} output needs kaleido (pip install kaleido), "
+                     'or pass --format html')
+
+    data_store.load_clean_df(args.data)  # build the Feather file once, before the workers start
+    frames, cube = load_data(args.data)
+    manifest = read_manifest(args.out)
+    code = code_hash()
+    todo = {}
+    for task in tasks():
+        if args.commodity and task[1] not in args.commodity:
+            continue
+        key = input_hash(*task, code)
+        names = [output_name(*task, fmt) for fmt in args.format]
+        if args.force or any(manifest.get(name) != key or not os.path.exists(os.path.join(args.out, name))
+                             for name in names):
+            todo[task] = (key, names)
+    print(f'{len(todo)} charts to render')
+    if not todo:
+        return
+
+    os.makedirs(args.out, exist_ok=True)
+    try:
+        with ProcessPoolExecutor(max_workers=args.jobs, initializer=init_worker,
+                                 initargs=(args.data, args.format)) as pool:
+            futures = {pool.submit(render, task, args.out, args.format): task for task in todo}
+            for future in as_completed(futures):
+                task = futures[future]
+                key, names = todo[task]
+                for path in future.result():
+                    print(path)
+                manifest.update({name: key for name in names})
+    finally:
+        write_manifest(args.out, manifest)  # keep whatever finished, even after an error
+
+
+if __name__ == '__main__':
+    main()
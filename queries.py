@@ -0,0 +1,143 @@
+"""Data queries behind the web tool, usable without Streamlit.
+
+The web tool (app.py), the JSON API (api.py) and scripts all go through these functions,
+so selecting a commodity, filtering by GHG range, summary statistics, country aggregates
+and trendline fits are computed the same way everywhere and cached in one place.
+"""
+import functools
+import io
+import os
+
+import numpy as np
+import pandas as pd
+
+import data_store
+import trendlines
+
+ghg = 'GHG Emissions'
+table_cols = data_store.numerical_cols + data_store.label_cols
+unknown_label = 'Unknown'  # shown in place of a missing Country or System when labelling
+
+
+class Dataset:
+    """Everything derived from one version of the raw data, given the cleaned sheet.
+
+    Built once per workbook version; nothing here is modified after construction.
+    """
+
+    def __init__(self, full_df, parse_failures, digest=None):
+        self.digest = digest
+        self.full_df = full_df
+        self.parse_failures = parse_failures
+        self.frames = data_store.commodity_frames(full_df)
+        self.ghg_indexes = {commodity: data_store.ghg_index(frame) for commodity, frame in self.frames.items()}
+        self.cube = data_store.aggregate_cube(self.frames)
+
+
+@functools.lru_cache(maxsize=2)
+def load_dataset(path=data_store.DATA_FILE, digest=None):
+    # the artifact already holds the cleaned sheet, so only the indexes are built here
+    digest = digest or data_store.workbook_hash(path)
+    return Dataset(*data_store.load_clean_df(path, digest), digest)
+
+
+@functools.lru_cache(maxsize=8)
+def stat_digest(path, mtime_ns, size):
+    return data_store.workbook_hash(path)
+
+
+def current_digest(path=data_store.DATA_FILE):
+    # only re-hash the workbook when its modification time or size changes
+    stat = os.stat(path)
+    return stat_digest(path, stat.st_mtime_ns, stat.st_size)
+
+
+def current_dataset(path=data_store.DATA_FILE):
+    return load_dataset(path, current_digest(path))
+
+
+def commodities(ds):
+    return list(ds.frames)
+
+
+def ghg_stops(ds, commodity):
+    """Every distinct GHG value of the commodity, for the range slider."""
+    return ds.ghg_indexes[commodity].stops
+
+
+def select(ds, commodity, low=None, high=None, label_by=()):
+    """Rows with low <= GHG <= high (and GHG >= 0), sorted by GHG.
+
+    Rows missing any of the label_by columns (Country and/or System) are kept and
+    labelled unknown_label, so labelling never hides data.
+    """
+    index = ds.ghg_indexes[commodity]
+    low = index.stops[0] if low is None else low
+    high = index.stops[-1] if high is None else high
+    rows = data_store.ghg_range(index, low, high)
+    if label_by:
+        rows = rows.assign(**{col: rows[col].fillna(unknown_label) for col in label_by})
+    return rows
+
+
+def full_range_stats(ds, commodity, indicator):
+    """count, mean, std, min, 25%, 50% (median), 75% and max over the whole commodity."""
+    return data_store.cube_slice(ds.cube, commodity, 'All', indicator).loc['']
+
+
+def range_stats(ds, commodity, indicator, low=None, high=None):
+    values = select(ds, commodity, low, high)[indicator]
+    full_range = full_range_stats(ds, commodity, indicator)
+    return {'count': int(values.count()), 'median': values.median(), 'mean': values.mean(),
+            'full_range_median': full_range['50%'], 'full_range_mean': full_range['mean']}
+
+
+def group_stats(ds, commodity, indicator, by='Country'):
+    """Summary statistics per country (or system), indexed by group."""
+    return data_store.cube_slice(ds.cube, commodity, by, indicator)
+
+
+@functools.lru_cache(maxsize=256)
+def trendline_fits(ds, commodity, indicator, low, high, kind, label_by=()):
+    """{trace name: trendlines.Fit} for the selected rows, cached by every argument."""
+    rows = select(ds, commodity, low, high, label_by)
+    return trendlines.fit_groups(rows, ghg, indicator, kind, by=label_by)
+
+
+def table_positions(rows, sort_by=None, ascending=True, search=''):
+    """Positions (into rows) of the rows matching search, in sort order.
+
+    search is a case-insensitive substring looked for in every text column. Only these
+    positions are computed; callers take just the window of rows they show.
+    """
+    positions = np.arange(len(rows))
+    if search:
+        text_cols = [col for col in rows.columns if rows[col].dtype.kind not in 'fiub']
+        match = np.zeros(len(rows), dtype=bool)
+        for col in text_cols:
+            match |= rows[col].astype(object).where(rows[col].notna(), '').astype(str) \
+                .str.contains(search, case=False, regex=False).to_numpy()
+        positions = positions[match]
+    if sort_by:
+        values = pd.Series(rows[sort_by].to_numpy()[positions])
+        order = values.sort_values(ascending=ascending, na_position='last', kind='stable').index
+        positions = positions[order.to_numpy()]
+    return positions
+
+
+def table_page(rows, positions, offset=0, limit=50, columns=None):
+    page = rows.iloc[positions[offset:offset + limit]]
+    return page if columns is None else page[columns]
+
+
+def csv_chunks(rows, positions, columns=None, chunk_rows=5000):
+    """The selected rows as CSV text, a few thousand rows at a time."""
+    for start in range(0, max(len(positions), 1), chunk_rows):
+        chunk = table_page(rows, positions, start, chunk_rows, columns)
+        yield chunk.to_csv(index=False, header=start == 0)
+
+
+def parquet_bytes(rows, positions, columns=None):
+    buffer = io.BytesIO()
+    table_page(rows, positions, 0, len(positions), columns).to_parquet(buffer, index=False)
+    return buffer.getvalue()
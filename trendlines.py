@@ -0,0 +1,80 @@
+"""Trendline fitting for the Impact Analysis scatter plots.
+
+Plotly Express refits statsmodels every time a figure is built with trendline='ols' or
+'lowess'. These functions do the same fits directly so the results can be cached and
+then drawn onto figures built without a trendline.
+"""
+import warnings
+from collections import namedtuple
+
+import numpy as np
+import plotly.graph_objects as go
+import statsmodels.api as sm
+
+# x, y: points of the fitted curve, sorted by x; table: coefficient table for OLS fits
+# (the same values as summary().tables[1]), None for LOWESS; hover: trendline hover text
+Fit = namedtuple('Fit', ['kind', 'x', 'y', 'table', 'hover'])
+
+
+def fit_ols(x, y):
+    results = sm.OLS(y, sm.add_constant(x)).fit()
+    order = np.argsort(x, kind='stable')
+    const, slope = results.params
+    # statsmodels warns about R-squared and normality tests on tiny or constant groups
+    with warnings.catch_warnings(), np.errstate(divide='ignore', invalid='ignore'):
+        warnings.simplefilter('ignore')
+        hover = f'<b>OLS trendline</b><br>y = {slope:g} * x + {const:g}<br>R<sup>2</sup>={results.rsquared:f}'
+        table = results.summary2().tables[1].rename(index={'x1': 'GHG Emissions'})
+    return Fit('ols', x[order], results.fittedvalues[order], table, hover)
+
+
+def fit_lowess(x, y):
+    # frac=0.6666666 is what plotly express passes; statsmodels' default of 2/3 gives a
+    # different neighbourhood size when the group size is a multiple of 3. Groups with
+    # repeated x values warn
+    with np.errstate(divide='ignore', invalid='ignore'):
+        curve = sm.nonparametric.lowess(y, x, frac=0.6666666, missing='drop')
+    return Fit('lowess', curve[:, 0], curve[:, 1], None, '<b>LOWESS trendline</b>')
+
+
+def fit(x, y, trendline):
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    keep = ~(np.isnan(x) | np.isnan(y))
+    x, y = x[keep], y[keep]
+    if len(np.unique(x)) < 2:  # no line through a single GHG value
+        return None
+    if trendline == 'ols':
+        return fit_ols(x, y)
+    if trendline == 'lowess':
+        return fit_lowess(x, y)
+    raise ValueError(f'Unknown trendline type: {trendline}')
+
+
+def fit_groups(df, x, y, trendline, by=()):
+    """Fit one trendline per group of rows, like px.scatter does per trace.
+
+    Groups are keyed by the trace name plotly express gives them (the label values
+    joined with ', ', or '' when there are no labels) and are in order of appearance.
+    """
+    by = list(by)
+    if not by:
+        return {'': fit(df[x], df[y], trendline)}
+    fits = {}
+    for labels, group in df.groupby(by, sort=False):
+        labels = labels if isinstance(labels, tuple) else (labels,)
+        fits[', '.join(str(label) for label in labels)] = fit(group[x], group[y], trendline)
+    return fits
+
+
+def add_trendlines(fig, fits):
+    """Draw cached fits onto a scatter figure, matching each fit to its trace by name."""
+    for trace in list(fig.data):
+        result = fits.get(trace.name or '')
+        if result is None:
+            continue
+        fig.add_trace(go.Scatter(
+            x=result.x, y=result.y, mode='lines', name=trace.name,
+            legendgroup=trace.legendgroup, showlegend=False,
+            line_color=trace.marker.color, hovertemplate=result.hover + '<extra></extra>'))
+    return fig